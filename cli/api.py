@@ -5,10 +5,11 @@ from typing import Optional, List, BinaryIO, NamedTuple, Dict, Callable
 
 import click
 import requests
-import pyperclip
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from . import auth, __version__
-from .config import API_V2_URL, get_env
+from . import auth, config, __version__
+from .config import get_env
 
 
 class ApiError(click.ClickException):
@@ -17,6 +18,9 @@ class ApiError(click.ClickException):
 
 def _read_clipboard() -> str:
     """Read the current contents of the user's clipboard."""
+    # pyperclip is only needed for interactive reauthentication
+    import pyperclip
+
     txt = pyperclip.paste()
     return txt
 
@@ -24,7 +28,10 @@ def _read_clipboard() -> str:
 def _url(endpoint: str) -> str:
     """Append `endpoint` to the API's base URL"""
     endpoint = endpoint.lstrip("/")
-    return f"{API_V2_URL}/{endpoint}"
+    return f"{config.API_V2_URL}/{endpoint}"
+
+
+_ERROR_BULLET = click.style("* ", fg="red", bold=True)
 
 
 def _error_message(response: requests.Response):
@@ -35,10 +42,7 @@ def _error_message(response: requests.Response):
         if type(message) == dict and "errors" in message:
             message_lines = ["Multiple errors:"]
             message_lines.extend(
-                [
-                    click.style("* ", fg="red", bold=True) + message
-                    for message in message["errors"]
-                ]
+                [_ERROR_BULLET + message for message in message["errors"]]
             )
             return "\n".join(message_lines)
         else:
@@ -49,27 +53,59 @@ def _error_message(response: requests.Response):
 
 _USER_AGENT = f"cidc-cli/{__version__}"
 
+# Share one session across API calls, so that requests made over the course of
+# a command (e.g., the several calls during an upload) reuse the same connection.
+_session = requests.Session()
+# Include user agent with info about the CLI version on every request
+_session.headers["User-Agent"] = _USER_AGENT
+
+# Retry transient gateway/availability errors with exponential backoff, so that a
+# blip on the API's side doesn't fail e.g. polling for an upload's merge status.
+# Only GETs are retried: POSTs aren't idempotent (e.g., initiating an upload), and
+# status PATCHes send an If-Match etag, so retrying one the server already applied
+# would fail with a 412.
+_RETRY_STATUSES = (429, 502, 503, 504)
+_RETRY_METHODS = frozenset(["GET"])
+try:
+    _retries = Retry(
+        total=5,
+        backoff_factor=0.3,
+        status_forcelist=_RETRY_STATUSES,
+        allowed_methods=_RETRY_METHODS,
+        raise_on_status=False,
+    )
+except TypeError:
+    # urllib3 < 1.26 calls `allowed_methods` `method_whitelist`
+    _retries = Retry(
+        total=5,
+        backoff_factor=0.3,
+        status_forcelist=_RETRY_STATUSES,
+        method_whitelist=_RETRY_METHODS,
+        raise_on_status=False,
+    )
+_session.mount("https://", HTTPAdapter(max_retries=_retries))
+_session.mount("http://", HTTPAdapter(max_retries=_retries))
+
 
 def _with_auth(headers: dict = None, id_token: str = None) -> dict:
     """Add an id token to the given headers"""
     if not id_token:
         id_token = auth.get_id_token()
-    return {
-        "Authorization": f"Bearer {id_token}",
-        # Also, include user agent with info about the CLI version
-        "User-Agent": _USER_AGENT,
-        **(headers or {}),
-    }
+    return {"Authorization": f"Bearer {id_token}", **(headers or {})}
 
 
 def check_auth(id_token: str) -> Optional[str]:
     """Check if an id_token is valid by making a request to the base API URL."""
-    response = requests.get(_url("/users/self"), headers=_with_auth(id_token=id_token))
+    response = _session.get(_url("/users/self"), headers=_with_auth(id_token=id_token))
 
     if response.status_code != 200:
         raise ApiError(_error_message(response))
 
 
+# How many times to prompt for a fresh ID token before giving up on a request
+MAX_REAUTH_ATTEMPTS = 5
+
+
 def retry_with_reauth(api_request):
     """
     For a function `api_request` that returns a `Response` object, if that response
@@ -77,11 +113,10 @@ def retry_with_reauth(api_request):
     and retry the request.
     """
 
-    TOKEN_URL = f'https://{"staging" if get_env() != "prod" else ""}portal.cimac-network.org/assays/cli-instructions'
-
     @wraps(api_request)
     def wrapped(*args, **kwargs):
         retry = True
+        reauth_attempts = 0
         while retry:
             res = api_request(*args, **kwargs)
             # If the error isn't auth-related, break out of the retry loop.
@@ -94,8 +129,15 @@ def retry_with_reauth(api_request):
             if "is not authorized to upload" in error_message:
                 raise ApiError(error_message)
 
+            # Only look up the environment once we actually need to send the user to the Portal.
+            TOKEN_URL = f'https://{"staging" if get_env() != "prod" else ""}portal.cimac-network.org/assays/cli-instructions'
+
             # Prompt the user for a new ID token.
             while True:
+                if reauth_attempts == MAX_REAUTH_ATTEMPTS:
+                    raise auth.unauthenticated()
+                reauth_attempts += 1
+
                 click.prompt(
                     (
                         "\nCIDC reauthentication required. Please copy a fresh identity token from the Portal "
@@ -143,12 +185,20 @@ def retry_with_reauth(api_request):
 
 
 class _RequestsWithReauth:
-    def __init__(self):
-        """Build a `request` instance with all methods wrapped in the `retry_with_reauth` decorator."""
-        pass
+    """
+    A `requests` stand-in with all methods of the shared session wrapped in the
+    `retry_with_reauth` decorator. Each wrapped method is built on first access
+    and reused afterwards.
+    """
+
+    def __getattr__(self, name):
+        def request(*args, **kwargs):
+            # Resolve the session method at call time so that it can be patched.
+            return getattr(_session, name)(*args, **kwargs)
 
-    def __getattribute__(self, name):
-        return retry_with_reauth(getattr(requests, name))
+        wrapped = retry_with_reauth(request)
+        setattr(self, name, wrapped)
+        return wrapped
 
 
 _requests_with_reauth = _RequestsWithReauth()
@@ -156,14 +206,14 @@ _requests_with_reauth = _RequestsWithReauth()
 
 def list_assays() -> List[str]:
     """Get a list of all supported assays."""
-    response = requests.get(_url("/info/assays"))
+    response = _session.get(_url("/info/assays"))
     assays = response.json()
     return assays
 
 
 def list_analyses() -> List[str]:
     """Get a list of all supported analyses."""
-    response = requests.get(_url("/info/analyses"))
+    response = _session.get(_url("/info/analyses"))
     assays = response.json()
     return assays
 
@@ -1,7 +1,5 @@
 """Methods for working with id tokens"""
 import click
-from jose import jwt
-from jose.exceptions import JWTError
 
 from . import api
 from . import cache
@@ -59,6 +57,10 @@ def get_id_token() -> str:
 
 def get_user_email() -> str:
     """Extract a user's email from their id token."""
+    # Only decoding a token needs jose, so don't load it for every `auth` import.
+    from jose import jwt
+    from jose.exceptions import JWTError
+
     token = get_id_token()
 
     # We don't need to check verifications here,
@@ -20,10 +20,8 @@ def _key_path(key: str) -> str:
 
 def store(key: str, value: str):
     """Persist a value across CLI commands."""
-    cdir = _cache_dir()
     # Create the cache directory if it doesn't exist
-    if not os.path.exists(cdir):
-        os.mkdir(cdir)
+    os.makedirs(_cache_dir(), exist_ok=True)
 
     # Save the provided value in a file named key
     with open(_key_path(key), "w") as cache:
@@ -32,12 +30,10 @@ def store(key: str, value: str):
 
 def get(key: str) -> Optional[str]:
     """Try to get a value for the given key"""
-    key_path = _key_path(key)
-
-    # Check if the key exists
-    if not os.path.exists(key_path):
+    # Get the value, if the key exists. Just trying to open the file
+    # saves a separate existence check on every cache lookup.
+    try:
+        with open(_key_path(key), "r") as value:
+            return value.read()
+    except FileNotFoundError:
         return None
-
-    # Get the value
-    with open(key_path, "r") as value:
-        return value.read()
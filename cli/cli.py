@@ -1,17 +1,25 @@
 """The second generation CIDC command-line interface."""
 import click
 
-from . import api, auth, gcloud, upload, config, consent, __version__
+# `api`, `auth`, and `upload` pull in requests, jose, etc., so they're imported
+# inside the commands that need them to keep `cidc --help` and friends snappy.
+from . import gcloud, config, consent, __version__
+
+# Subcommands that never shell out to gcloud, so we can skip checking for it
+_NO_GCLOUD_COMMANDS = {"version", "config"}
+
 
 #### $ cidc ####
 @click.group()
 @click.option("-i", "--ignore", default=None, hidden=True)
-def cidc(ignore):
+@click.pass_context
+def cidc(ctx, ignore):
     """The CIDC command-line interface."""
     config.check_env_warning(ignore)
     if not consent.check_consent():
         exit(0)
-    gcloud.check_installed()
+    if ctx.invoked_subcommand not in _NO_GCLOUD_COMMANDS:
+        gcloud.check_installed()
 
 
 #### $ cidc version ####
@@ -26,6 +34,8 @@ def version():
 @click.argument("portal_token", required=True, type=str)
 def login(portal_token):
     """Validate and cache the given token"""
+    from . import auth
+
     click.echo("Validating token...")
     auth.validate_and_cache_token(portal_token)
     click.echo("You are now logged in.")
@@ -65,6 +75,8 @@ def admin_():
 @click.command()
 def test_csms():
     """A simple API hit for a test of CSMS connection"""
+    from . import api
+
     api.test_csms()
 
 
@@ -72,6 +84,8 @@ def test_csms():
 @click.command()
 def grant_all():
     """A simple API hit for a test of CSMS connection"""
+    from . import api
+
     api.grant_all_download_permissions()
 
 
@@ -79,6 +93,8 @@ def grant_all():
 @click.command()
 def load_blobs():
     """A simple API hit to fill the relational database from the JSON blobs"""
+    from . import api
+
     api.load_from_blobs()
 
 
@@ -92,6 +108,8 @@ def assays():
 @click.command("list")
 def list_assays():
     """List all supported assay types."""
+    from . import api
+
     assay_list = api.list_assays()
     for assay in assay_list:
         click.echo(f"* {assay}")
@@ -105,6 +123,8 @@ def upload_assay(assay, xlsx):
     """
     Upload data for an assay.
     """
+    from . import upload
+
     upload.run_upload(assay, xlsx)
 
 
@@ -118,6 +138,8 @@ def analyses():
 @click.command("list")
 def list_analyses():
     """List all supported analysis types."""
+    from . import api
+
     analysis_list = api.list_analyses()
     for analysis in analysis_list:
         click.echo(f"* {analysis}")
@@ -133,6 +155,8 @@ def upload_analysis(analysis, xlsx):
     """
     Upload data for an analysis.
     """
+    from . import upload
+
     upload.run_upload(analysis, xlsx, is_analysis=True)
 
 
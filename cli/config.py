@@ -23,57 +23,71 @@ def get_env():
     return cache.get(_ENV_KEY) or "prod"
 
 
-_WARNING = "\n".join(
-    [
-        "##      ##    ###    ########  ##    ## #### ##    ##  ######   ",
-        "##  ##  ##   ## ##   ##     ## ###   ##  ##  ###   ## ##    ##  ",
-        "##  ##  ##  ##   ##  ##     ## ####  ##  ##  ####  ## ##        ",
-        "##  ##  ## ##     ## ########  ## ## ##  ##  ## ## ## ##   #### ",
-        "##  ##  ## ######### ##   ##   ##  ####  ##  ##  #### ##    ##  ",
-        "##  ##  ## ##     ## ##    ##  ##   ###  ##  ##   ### ##    ##  ",
-        " ###  ###  ##     ## ##     ## ##    ## #### ##    ##  ######   ",
-        "",
-    ]
+_WARNING = (
+    "##      ##    ###    ########  ##    ## #### ##    ##  ######   \n"
+    "##  ##  ##   ## ##   ##     ## ###   ##  ##  ###   ## ##    ##  \n"
+    "##  ##  ##  ##   ##  ##     ## ####  ##  ##  ####  ## ##        \n"
+    "##  ##  ## ##     ## ########  ## ## ##  ##  ## ## ## ##   #### \n"
+    "##  ##  ## ######### ##   ##   ##  ####  ##  ##  #### ##    ##  \n"
+    "##  ##  ## ##     ## ##    ##  ##   ###  ##  ##   ### ##    ##  \n"
+    " ###  ###  ##     ## ##     ## ##    ## #### ##    ##  ######   \n"
 )
 _STRIKE = "*" * 64
+# Printed whenever the CLI isn't pointed at the expected environment
+_BANNER = _STRIKE + "\n" + _WARNING + _STRIKE
 
 
 def check_env_warning(ignore_env):
     """Get the current CLI environment"""
-    if get_env() != "prod":
-        print(_STRIKE + "\n" + _WARNING + _STRIKE)
-        print(f"You are using DEVELOPMENT environment ({get_env()})")
-        if ignore_env != None and ignore_env == get_env():
+    # Read the env from the cache once, rather than once per check below
+    current_env = get_env()
+    if current_env != "prod":
+        click.echo(f"{_BANNER}\nYou are using DEVELOPMENT environment ({current_env})")
+        if ignore_env != None and ignore_env == current_env:
             return
 
-        print("If you are not sure what that means, stop now.\n" + _STRIKE)
+        click.echo(f"If you are not sure what that means, stop now.\n{_STRIKE}")
 
         if not click.confirm("Proceed anyways?"):
             if click.confirm(
                 "Do you want to reset the CLI to its default configuration?"
             ):
                 set_env("prod")
-                print(_STRIKE)
-                print("Environment set to default, you can retry now.")
+                click.echo(f"{_STRIKE}\nEnvironment set to default, you can retry now.")
             exit(0)
 
-        print(_STRIKE)
+        click.echo(_STRIKE)
 
-    if ignore_env != None and ignore_env != get_env():
-        print(_STRIKE + "\n" + _WARNING + _STRIKE)
-        print(f"You are using PRODUCTION environment, not {ignore_env}")
-        print(f"Remove `--ignore {ignore_env}` and retry.")
-        print(_STRIKE)
+    if ignore_env != None and ignore_env != current_env:
+        click.echo(
+            f"{_BANNER}\n"
+            f"You are using PRODUCTION environment, not {ignore_env}\n"
+            f"Remove `--ignore {ignore_env}` and retry.\n"
+            f"{_STRIKE}"
+        )
         exit(0)
 
 
 # Environment-specific config
-_current_env = get_env()
-if _current_env == "prod":
-    API_V2_URL = "https://api.cimac-network.org"
-elif _current_env == "staging":
-    API_V2_URL = "https://staging-api.cimac-network.org"
-elif _current_env == "dev":
-    API_V2_URL = "http://localhost:8000"
-else:
-    raise ValueError(f"Unsupported environment: {_current_env}")
+_API_V2_URLS = {
+    "prod": "https://api.cimac-network.org",
+    "staging": "https://staging-api.cimac-network.org",
+    "dev": "http://localhost:8000",
+}
+
+
+def __getattr__(name: str):
+    """
+    Resolve environment-specific config the first time it's accessed rather than
+    at import, so commands that never talk to the API don't read the env cache.
+    """
+    if name == "API_V2_URL":
+        current_env = get_env()
+        if current_env not in _API_V2_URLS:
+            raise ValueError(f"Unsupported environment: {current_env}")
+
+        global API_V2_URL
+        API_V2_URL = _API_V2_URLS[current_env]
+        return API_V2_URL
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -4,8 +4,6 @@ import subprocess
 
 import click
 
-from . import auth
-
 GCLOUD = "gcloud"
 
 
@@ -18,10 +16,33 @@ def check_installed():
         )
 
 
+def _is_logged_in(email: str) -> bool:
+    """Check if gcloud is already using working credentials for `email`."""
+    account = subprocess.run(
+        [GCLOUD, "config", "get-value", "account"],
+        capture_output=True,
+        universal_newlines=True,
+    )
+    if account.returncode != 0 or account.stdout.strip() != email:
+        return False
+
+    # Make sure the stored credentials haven't expired or been revoked
+    token = subprocess.run(
+        [GCLOUD, "auth", "print-access-token", email], capture_output=True
+    )
+    return token.returncode == 0
+
+
 def login():
     """Check if a user is logged in to gcloud, and log them in if not."""
+    from . import auth
+
     email = auth.get_user_email()
 
+    # Skip the interactive login flow if the user is already logged in
+    if _is_logged_in(email):
+        return
+
     # Try to log the user in to gcloud with their CIDC email
     click.secho("$ gcloud auth login --no-launch-browser --brief", dim=True)
     subprocess.call([GCLOUD, "auth", "login", email, "--no-launch-browser", "--brief"])
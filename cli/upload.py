@@ -2,11 +2,12 @@
 import os
 import time
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from datetime import datetime
-from typing import BinaryIO, Dict, Generator, List, Optional, Tuple
+from typing import BinaryIO, Dict, Generator, List, Optional, Set, Tuple
 
 import click
+import requests
 
 from . import api
 from . import gcloud
@@ -30,6 +31,9 @@ def run_upload(upload_type: str, xlsx_path: str, is_analysis: bool = False):
        Else, if the upload succeeds, alert the api that the job was
        successful.
     """
+    # Catch a bad CIDC_GSUTIL_PROCS before starting an upload job
+    _max_gsutil_procs()
+
     # Log in to gcloud (required for gsutil to work)
     gcloud.login()
 
@@ -54,9 +58,12 @@ def run_upload(upload_type: str, xlsx_path: str, is_analysis: bool = False):
             ) as open_files:
                 api.insert_extra_metadata(upload_info.job_id, open_files)
 
+        # Work out which files to upload (which can mean listing whole GCS buckets)
+        upload_pairs, skipping = _compose_file_mapping(upload_info, xlsx_path)
+
         # Actually upload the assay data
         click.secho(f"> initiating GCS upload", dim=True)
-        gcs_file_map = _gsutil_assay_upload(upload_info, xlsx_path)
+        gcs_file_map = _gsutil_assay_upload(upload_info, upload_pairs, skipping)
     except (Exception, KeyboardInterrupt) as e:
         # we need to notify api of a failed upload
         api.upload_failed(
@@ -85,12 +92,11 @@ def _open_file_mapping(extra_metadata: dict, base_path: str) -> Dict[str, Binary
     """
     base_dir = os.path.abspath(os.path.dirname(base_path))
 
-    open_files = {}
-    for source_path, uuid in extra_metadata.items():
-
-        # if user wants us to get file from GCS
-        # and we want it to be analysed for extra_md
-        # we say we don't support it
+    # if user wants us to get file from GCS
+    # and we want it to be analysed for extra_md
+    # we say we don't support it. Check this before
+    # opening any files, so there's nothing to clean up.
+    for source_path in extra_metadata:
         if source_path.startswith("gs://"):
             raise Exception(
                 "File transfers from Google Cloud Storage are not supported for this assay type."
@@ -98,12 +104,12 @@ def _open_file_mapping(extra_metadata: dict, base_path: str) -> Dict[str, Binary
                 " update the file paths in your metadata Excel file, and try again"
             )
 
-        source_path = os.path.join(base_dir, source_path)
-        open_files[uuid] = open(source_path, "rb")
+    open_files = {}
     try:
+        for source_path, uuid in extra_metadata.items():
+            source_path = os.path.join(base_dir, source_path)
+            open_files[uuid] = open(source_path, "rb")
         yield open_files
-    except:
-        raise
     finally:
         for f in open_files.values():
             f.close()
@@ -113,7 +119,7 @@ def _open_file_mapping(extra_metadata: dict, base_path: str) -> Dict[str, Binary
 # We don't want them to see that or enable `parallel_composite_upload_threshold`
 # because composite files are problematic to download - see:
 # https://cloud.google.com/storage/docs/gsutil/commands/cp#parallel-composite-uploads
-_IGNORED_WARN_LINES = set(
+_IGNORED_WARN_LINES = frozenset(
     map(
         str.strip,
         """==> NOTE: You are uploading one or more large file(s), which would run
@@ -126,9 +132,7 @@ be uploaded as `composite objects
 means that any user who downloads such objects will need to have a
 compiled crcmod installed (see "gsutil help crcmod"). This is because
 without a compiled crcmod, computing checksums on composite objects is
-so slow that gsutil disables downloads of composite objects.""".split(
-            "\n"
-        ),
+so slow that gsutil disables downloads of composite objects.""".splitlines(),
     )
 )
 
@@ -143,14 +147,7 @@ def _start_procs(src_dst_pairs: list) -> Generator[subprocess.Popen, None, None]
     """
     procs = []
 
-    src_dst_stack = list(src_dst_pairs)
-
-    while True:
-        try:
-            src, dst = src_dst_stack.pop()
-        except IndexError:
-            return
-
+    for src, dst in src_dst_pairs:
         # Construct the upload command
         gsutil_args = ["gsutil", "cp", src, dst]
 
@@ -163,134 +160,192 @@ def _start_procs(src_dst_pairs: list) -> Generator[subprocess.Popen, None, None]
                 stdout=subprocess.DEVNULL,
                 stderr=subprocess.PIPE,
             )
-            procs.append(p)
-            yield p
-
-        except OSError as e:
-            # stopping already created processes
-            for p in procs:
-                p.kill()
-            _handle_upload_exc(e)
-
         except Exception as e:
             # stopping already created processes
             for p in procs:
                 p.kill()
             _handle_upload_exc(e)
 
+        procs.append(p)
+        yield p
+
+
+_UPLOAD_ERROR = click.style("!!! upload error !!! ", fg="red", bold=True)
+
+
+def _upload_feedback(done: int, total: int, i: int) -> str:
+    """Build the start of a user feedback message about the upload of file `i`"""
+    return f"[{done}/{total} done] " + click.style(f"(file {i + 1}) ", fg="bright_blue")
+
 
 def _wait_for_upload(
-    procs: list, total: int, optional_files: List[str]
+    procs: list,
+    total: int,
+    optional_files: List[str],
+    wait_for_all: bool = True,
+    prev_errlines: Optional[Dict[int, str]] = None,
+    finished: Optional[Set[int]] = None,
 ) -> Optional[str]:
     """
-    Waits for all subprocesses and click.echos their stderr streams.
+    Waits for all subprocesses (or, if `wait_for_all` is False, for at least one
+    more of them to finish) and click.echos their stderr streams.
     Returns Optional[str] - an error message if an error has occurred during any if uploads
     """
 
-    # First we account all already successfully finished procs
-    finished = set([i for i, p in enumerate(procs) if p.poll() == 0])
+    # Callers that wait repeatedly on the same processes pass in the indices of
+    # the ones already handled, so that processes exiting between calls still
+    # get the rest of their output read and their stderr pipe closed.
+    if finished is None:
+        finished = set()
+    already_finished = len(finished)
 
     error = None
 
     # GCS upload errors are generally spread across two lines.
     # Since we consume stderr one line at a time will polling upload processes,
     # we need to save the previous stderr line for each process in order
-    # to reconstruct a full GCS upload error.
-    prev_errlines = {}
+    # to reconstruct a full GCS upload error. Callers that wait repeatedly on
+    # the same processes can pass in a dict to keep these lines between calls.
+    if prev_errlines is None:
+        prev_errlines = {}
     while len(finished) != len(procs) and not error:
+        if not wait_for_all and len(finished) > already_finished:
+            break
+
         for i, p in enumerate(procs):
             if i in finished:
                 continue
 
-            # start building user feedback for this process
-            message = f"[{len(finished)}/{total} done] "
-            message += click.style(f"(file {i + 1}) ", fg="bright_blue")
+            # count for user feedback, which we only build if there's
+            # something to show, since most stderr lines are skipped
+            done = len(finished)
 
             # read stderr for this process
-            errline = p.stderr.readline()
+            errlines = [p.stderr.readline()]
 
+            failed = False
             if p.poll() is not None:
+                # read whatever else the process wrote before exiting
+                errlines.extend(p.stderr)
                 p.stderr.close()
                 finished.add(i)
+                failed = p.returncode != 0
 
-                if p.returncode != 0:
-                    message += click.style("!!! upload error !!! ", fg="red", bold=True)
-                    message += p.args[-2]
-                    click.echo(message)
-                    # Reconstruct multiline GCS error message
-                    error = f"{prev_errlines.get(i, '')}{errline}"
-                    break
+            # the last line of a failed upload completes its error message
+            last_errline = errlines.pop() if failed else None
 
-            # skipping "large file" warnings
-            if errline.strip() in _IGNORED_WARN_LINES:
-                continue
+            for errline in errlines:
+                # skipping "large file" warnings
+                if errline.strip() in _IGNORED_WARN_LINES:
+                    continue
 
-            if (
-                errline
-                and len(errline) > 2  # skip '* ' spinner lines
-                and errline.split("]", 1)[0].endswith(
-                    "1 files"
-                )  # include gsutil output with upload progress
-            ):
-                message += errline.split("]", 1)[1].rstrip()
-                message += f" {p.args[-2]}"
+                progress, _, details = errline.partition("]")
+                if (
+                    errline
+                    and len(errline) > 2  # skip '* ' spinner lines
+                    and progress.endswith("1 files")  # include gsutil upload progress
+                ):
+                    message = _upload_feedback(done, total, i)
+                    message += details.rstrip()
+                    message += f" {p.args[-2]}"
+                    click.echo(message)
+                elif errline:
+                    # This might be the first line of a multiline error message,
+                    # so save it.
+                    prev_errlines[i] = errline
+
+            if failed:
+                message = _upload_feedback(done, total, i)
+                message += _UPLOAD_ERROR
+                message += p.args[-2]
                 click.echo(message)
-            else:
-                # This might be the first line of a multiline error message,
-                # so save it.
-                prev_errlines[i] = errline
+                # Reconstruct multiline GCS error message, making sure the
+                # failure is reported even if gsutil didn't say anything
+                error = (
+                    f"{prev_errlines.get(i, '')}{last_errline}"
+                    or f"gsutil exited with {p.returncode}"
+                )
+                break
 
     return error
 
 
-# default from `gsutil -m` but maybe better to load from env
+# default from `gsutil -m`, but can be tuned with the CIDC_GSUTIL_PROCS env var
 MAX_GSUTIL_PARALLEL_PROCESS = 12
 
 
-def _gsutil_assay_upload(upload_info: api.UploadInfo, xlsx: str) -> Dict[str, str]:
+def _max_gsutil_procs() -> int:
+    """Get how many gsutil processes to run at once"""
+    procs = os.environ.get("CIDC_GSUTIL_PROCS")
+    if not procs:
+        return MAX_GSUTIL_PARALLEL_PROCESS
+    try:
+        return max(1, int(procs))
+    except ValueError:
+        raise click.ClickException(
+            f"CIDC_GSUTIL_PROCS must be a whole number, not {procs!r}."
+        )
+
+
+def _gsutil_assay_upload(
+    upload_info: api.UploadInfo,
+    upload_pairs: List[Tuple[str, str]],
+    skipping: List[str],
+) -> Dict[str, str]:
     """
-    Upload local assay data to GCS using gsutil.
+    Upload local assay data to GCS using gsutil, given the (source path, target uri)
+    pairs to upload and the missing optional files to skip from `_compose_file_mapping`.
     Return modified GCS file map with missing files removed
     """
 
-    upload_pairs, skipping = _compose_file_mapping(upload_info, xlsx)
     file_count = len(upload_pairs)
     for s in skipping:
         upload_info.gcs_file_map.pop(s, "")
 
+    max_procs = _max_gsutil_procs()
     proc_iter = _start_procs(upload_pairs)
     procs = []
+    prev_errlines, finished = {}, set()
     all_uploads_have_run = False
     while not all_uploads_have_run:
 
-        # Here we start with just 1 parallel process and gradually
-        # increase that to MAX_GSUTIL_PARALLEL_PROCESS doubling the number every time.
+        # Here we start with just 1 process, so that errors common to every
+        # upload (e.g., bad credentials) surface before we spawn any more.
+        # After that, we keep `max_procs` uploads running,
+        # starting a new one whenever another finishes rather than
+        # waiting for a whole batch to complete.
+        running = sum(p.poll() is None for p in procs)
+        how_many_to_add = (max_procs if procs else 1) - running
         try:
-            current_count = len(procs) or 1  # 1 is for starters
-            how_many_to_add = min(current_count, MAX_GSUTIL_PARALLEL_PROCESS)
             for _ in range(how_many_to_add):
                 procs.append(next(proc_iter))
         except StopIteration:
             all_uploads_have_run = True
 
-        err = _wait_for_upload(procs, file_count, upload_info.optional_files)
+        # Once every upload has started, wait for all of them to finish
+        err = _wait_for_upload(
+            procs,
+            file_count,
+            upload_info.optional_files,
+            wait_for_all=all_uploads_have_run,
+            prev_errlines=prev_errlines,
+            finished=finished,
+        )
 
         if err:
-            for p in procs:
-
-                if p.poll() != 0:
+            failed = next(p for p in procs if p.poll() not in (None, 0))
 
-                    # stopping all other processes
-                    for other_p in procs:
-                        if p != other_p:
-                            other_p.kill()
+            # stopping all other processes
+            for p in procs:
+                if p is not failed and p.poll() is None:
+                    p.kill()
 
-                    click.echo(
-                        f"\nGCS upload failed on {p.args[-2]} with the following message:\n"
-                    )
-                    click.secho(f"{err}", fg="red")
+            click.echo(
+                f"\nGCS upload failed on {failed.args[-2]} with the following message:\n"
+            )
+            click.secho(f"{err}", fg="red")
 
-                    raise click.Abort()
+            raise click.Abort()
 
     click.echo(
         f"[{file_count}/{file_count} done] All files uploaded to GCS and staged for ingestion."
@@ -299,41 +354,73 @@ def _gsutil_assay_upload(upload_info: api.UploadInfo, xlsx: str) -> Dict[str, st
     return upload_info.gcs_file_map
 
 
+# how many source buckets to list with `gsutil ls` at once
+MAX_PARALLEL_BUCKET_LISTINGS = 12
+
+
+def _list_gs_bucket(bucket: str) -> Set[str]:
+    """List the URIs of all objects in `bucket` with a single `gsutil ls`"""
+    # Read the listing line by line as gsutil produces it, rather than
+    # buffering the whole thing, since a bucket can hold a lot of objects.
+    # gsutil prints object names as UTF-8, whatever the platform's locale
+    proc = subprocess.Popen(
+        ["gsutil", "ls", "-r", f"gs://{bucket}"],
+        encoding="utf-8",
+        errors="replace",
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+
+    # return in the format
+    # folder:
+    # gs://bucket/[file]
+    # gs://bucket/[file...]
+    #
+    # [folder...]:
+    file_list, other_lines = set(), []
+    try:
+        for line in map(str.strip, proc.stdout):
+            if line.startswith("gs://"):
+                if not line.endswith(":"):
+                    file_list.add(line)
+            elif line:
+                other_lines.append(line)
+    except BaseException:
+        # don't leave gsutil running if reading its output failed
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+
+    if returncode != 0:
+        click.secho(
+            f"Error getting {bucket} to check files: {' '.join(other_lines)}",
+            fg="red",
+            bold=True,
+        )
+        raise click.Abort()
+    # didn't fail
+
+    return file_list
+
+
 def _check_for_gs_files(
     gs_uris_to_check: Dict[str, Dict[str, str]],
-    optional_files: List[str],
+    optional_files: Set[str],
     target_bucket: str,
 ):
     """Smart checking of gs:// URIs to ensure that files exist"""
     res, missing_required_files, missing_optional_files = [], [], []
+    target_prefix = f"gs://{target_bucket}/"
 
-    # separate by bucket, to do single ls per bucket
-    # then check in the return for all the files
-    for bucket, gs_file_mapping in gs_uris_to_check.items():
-        sub = subprocess.run(
-            ["gsutil", "ls", "-r", f"gs://{bucket}"], capture_output=True
-        )
-        if sub.returncode != 0:
-            click.secho(
-                f"Error getting {bucket} to check files: {sub.stderr.decode('utf-8'), }",
-                fg="red",
-                bold=True,
-            )
-            raise click.Abort()
-        # didn't fail
-
-        # return in the format
-        # folder:
-        # gs://bucket/[file]
-        # gs://bucket/[file...]
-        #
-        # [folder...]:
-        file_list = set()
-        for f in sub.stdout.decode("utf-8").split("\n"):
-            f = f.strip()
-            if f and not f.endswith(":"):
-                file_list.add(f)
+    # separate by bucket, to do single ls per bucket, and run
+    # the (network-bound) listings for all buckets concurrently
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_BUCKET_LISTINGS) as executor:
+        file_lists = executor.map(_list_gs_bucket, gs_uris_to_check)
 
+    # then check in the return for all the files
+    for gs_file_mapping, file_list in zip(gs_uris_to_check.values(), file_lists):
         for gs_source_path, gcs_uri in gs_file_mapping.items():
             if gs_source_path not in file_list:
                 if gs_source_path in optional_files:
@@ -346,18 +433,24 @@ def _check_for_gs_files(
                 # see https://cloud.google.com/storage/docs/gsutil/addlhelp/WildcardNames#other-wildcard-characters
                 # this replaces opening with a generic wildcard, which can only map to only a single bucket
                 res.append(
-                    [
-                        gs_source_path.replace("[", "?"),
-                        f"gs://{target_bucket}/{gcs_uri}",
-                    ]
+                    (gs_source_path.replace("[", "?"), f"{target_prefix}{gcs_uri}")
                 )
 
     return res, missing_required_files, missing_optional_files
 
 
+def _list_local_files(directory: str) -> Set[str]:
+    """List the names of all regular files in `directory` with a single scan."""
+    try:
+        with os.scandir(directory) as entries:
+            return {entry.name for entry in entries if entry.is_file()}
+    except OSError:
+        return set()
+
+
 def _compose_file_mapping(
     upload_info: api.UploadInfo, xlsx: str
-) -> Tuple[Dict[str, str], List[str]]:
+) -> Tuple[List[Tuple[str, str]], List[str]]:
     """
     Returns a list of (source_path, target uri) pairs for all 
     the files from the upload info relative to the `work dir` 
@@ -368,6 +461,11 @@ def _compose_file_mapping(
     missing_optional_files = []
     missing_required_files = []
     xlsx_dir = os.path.abspath(os.path.dirname(xlsx))
+    optional_files = set(upload_info.optional_files)
+
+    # scan each local directory once instead of stat-ing every file in it
+    local_files = {}
+    target_prefix = f"gs://{upload_info.gcs_bucket}/"
 
     gs_uris_to_check = {}
     for source_path, gcs_uri in upload_info.url_mapping.items():
@@ -377,31 +475,38 @@ def _compose_file_mapping(
         if not source_path.startswith("gs://"):
             source_path = os.path.join(xlsx_dir, source_path)
 
-            if not os.path.isfile(source_path):
-                if source_path in upload_info.optional_files:
+            source_dir, source_name = os.path.split(source_path)
+            dir_files = local_files.get(source_dir)
+            if dir_files is None:
+                dir_files = local_files[source_dir] = _list_local_files(source_dir)
+
+            # fall back to a stat on a miss, since names may not match
+            # exactly on case-insensitive filesystems
+            if source_name not in dir_files and not os.path.isfile(source_path):
+                if source_path in optional_files:
                     missing_optional_files.append(gcs_uri)
-                    continue
                 else:
                     missing_required_files.append(source_path)
-            res.append([source_path, f"gs://{upload_info.gcs_bucket}/{gcs_uri}"])
+                continue
+            res.append((source_path, f"{target_prefix}{gcs_uri}"))
 
         else:
             # separate by bucket, to do single ls per bucket
             # gsutil treats brackets in a gs-uri as a character set
             # see https://cloud.google.com/storage/docs/gsutil/addlhelp/WildcardNames#other-wildcard-characters
             # this replaces opening with a generic wildcard, which can only map to only a single bucket
-            bucket = source_path[5:].split("/")[0].replace("[", "?")
-            if bucket not in gs_uris_to_check:
-                gs_uris_to_check[bucket] = {}
-            gs_uris_to_check[bucket][source_path] = gcs_uri
+            bucket = source_path[5:].partition("/")[0].replace("[", "?")
+            gs_uris_to_check.setdefault(bucket, {})[source_path] = gcs_uri
 
-    gs_res, missing_required_gs_files, missing_optional_gs_files = _check_for_gs_files(
-        gs_uris_to_check, upload_info.optional_files, upload_info.gcs_bucket
-    )
+    # Listing GCS buckets is slow, so skip it if the upload is already doomed
+    if not missing_required_files:
+        gs_res, missing_required_gs, missing_optional_gs = _check_for_gs_files(
+            gs_uris_to_check, optional_files, upload_info.gcs_bucket
+        )
 
-    res.extend(gs_res)
-    missing_required_files.extend(missing_required_gs_files)
-    missing_optional_files.extend(missing_optional_gs_files)
+        res.extend(gs_res)
+        missing_required_files.extend(missing_required_gs)
+        missing_optional_files.extend(missing_optional_gs)
 
     if missing_required_files:
         raise Exception(
@@ -411,20 +516,32 @@ def _compose_file_mapping(
     return res, missing_optional_files
 
 
+# longest wait, in seconds, between retries of a failed upload status check
+MAX_POLL_BACKOFF = 30
+
+
 def _poll_for_upload_completion(
     job_id: int, job_token: str, timeout: int = 600, _did_timeout_test_impl=None
 ):
     """Repeatedly check if upload finalization either failed or succeed"""
-    cutoff = datetime.now().timestamp() + timeout
+    cutoff = time.monotonic() + timeout
 
-    did_timeout = _did_timeout_test_impl or (
-        lambda: datetime.now().timestamp() >= cutoff
-    )
+    did_timeout = _did_timeout_test_impl or (lambda: time.monotonic() >= cutoff)
 
     debug_info_message = f"Please include this info in your inquiry: (job_id={job_id})"
 
+    backoff = 1
     while not did_timeout():
-        status = api.poll_upload_merge_status(job_id, job_token)
+        try:
+            status = api.poll_upload_merge_status(job_id, job_token)
+        except requests.ConnectionError:
+            # Don't give up on the upload over a network blip, but back off
+            # so we don't hammer the API while it's unreachable.
+            time.sleep(backoff)
+            backoff = min(backoff * 2, MAX_POLL_BACKOFF)
+            continue
+        backoff = 1
+
         if status.retry_in:
             # Loop in one second increments, checking
             # for a timeout on each iteration.
@@ -470,4 +587,11 @@ def _handle_upload_exc(e: Exception):
     """Handle an exception thrown during an upload attempt."""
     if isinstance(e, KeyboardInterrupt):
         raise KeyboardInterrupt(f"Upload canceled.")
-    raise type(e)(f"Upload failed.\n{e}") from e
+    message = f"Upload failed.\n{e}"
+    try:
+        exc = type(e)(message)
+    except TypeError:
+        # Some exceptions (e.g., subprocess.CalledProcessError) can't be built
+        # from a message alone - don't let that mask the original error.
+        exc = Exception(message)
+    raise exc from e
@@ -23,7 +23,7 @@ def make_error_response(msg: Union[str, list], code: int = 400) -> MagicMock:
 
 
 def patch_request(http_verb, response, monkeypatch):
-    monkeypatch.setattr(f"requests.{http_verb}", lambda *args, **kwargs: response)
+    monkeypatch.setattr(api._session, http_verb, lambda *args, **kwargs: response)
 
 
 def test_url_builder():
@@ -65,10 +65,7 @@ def test_error_message_extractor():
 def test_with_auth(monkeypatch):
     """Test the authorization header builder"""
     TOKEN = "tok"
-    AUTH_HEADER = {
-        "Authorization": f"Bearer {TOKEN}",
-        "User-Agent": f"cidc-cli/{__version__}",
-    }
+    AUTH_HEADER = {"Authorization": f"Bearer {TOKEN}"}
     OTHER_HEADERS = {"If-Match": "blah blah blah", "Content-Type": "application/json"}
     HEADERS = {**OTHER_HEADERS, **AUTH_HEADER}
 
@@ -81,6 +78,22 @@ def test_with_auth(monkeypatch):
     assert api._with_auth(headers=OTHER_HEADERS) == HEADERS
 
 
+def test_session_user_agent():
+    """Check that every API request identifies the CLI version"""
+    assert api._session.headers["User-Agent"] == f"cidc-cli/{__version__}"
+
+
+def test_session_retries():
+    """Check that transient errors are retried for GET requests only"""
+    retries = api._session.get_adapter("https://api.cimac-network.org").max_retries
+    assert retries.total == 5
+    assert 503 in retries.status_forcelist
+    assert retries.is_retry("GET", 503)
+    assert not retries.is_retry("PATCH", 503)
+    assert not retries.is_retry("POST", 503)
+    assert not retries.is_retry("GET", 500)
+
+
 def test_check_auth(monkeypatch):
     """Check that api.check_auth handles errors as expected"""
     # Auth error
@@ -137,7 +150,7 @@ def test_initiate_upload(monkeypatch):
             }
         )
 
-    monkeypatch.setattr("requests.post", good_request)
+    monkeypatch.setattr("cli.api._session.post", good_request)
     api.initiate_upload(ASSAY, XLSX)
 
     ERR = "bad request or something"
@@ -172,10 +185,10 @@ def test_update_job_status(monkeypatch):
 
         return request
 
-    monkeypatch.setattr("requests.patch", test_status("upload-completed"))
+    monkeypatch.setattr("cli.api._session.patch", test_status("upload-completed"))
     api.upload_succeeded(JOB_ID, UPLOAD_TOKEN, JOB_ETAG, UPLOAD_URL_MAP)
 
-    monkeypatch.setattr("requests.patch", test_status("upload-failed"))
+    monkeypatch.setattr("cli.api._session.patch", test_status("upload-failed"))
     api.upload_failed(JOB_ID, UPLOAD_TOKEN, JOB_ETAG, UPLOAD_URL_MAP)
 
 
@@ -186,21 +199,21 @@ def test_poll_upload_merge_status(monkeypatch):
     def not_found_get(*args, **kwargs):
         return make_error_response("", code=404)
 
-    monkeypatch.setattr("requests.get", not_found_get)
+    monkeypatch.setattr("cli.api._session.get", not_found_get)
     with pytest.raises(api.ApiError):
         api.poll_upload_merge_status(1, UPLOAD_TOKEN)
 
     def bad_response_get(*args, **kwargs):
         return make_json_response({})
 
-    monkeypatch.setattr("requests.get", bad_response_get)
+    monkeypatch.setattr("cli.api._session.get", bad_response_get)
     with pytest.raises(api.ApiError, match="unexpected upload status message"):
         api.poll_upload_merge_status(1, UPLOAD_TOKEN)
 
     def good_retry_get(*args, **kwargs):
         return make_json_response({"retry_in": 5})
 
-    monkeypatch.setattr("requests.get", good_retry_get)
+    monkeypatch.setattr("cli.api._session.get", good_retry_get)
     upload_status = api.poll_upload_merge_status(1, UPLOAD_TOKEN)
     assert upload_status.retry_in == 5
     assert upload_status.status is None
@@ -211,7 +224,7 @@ def test_poll_upload_merge_status(monkeypatch):
     def good_status_get(*args, **kwargs):
         return make_json_response(status_res)
 
-    monkeypatch.setattr("requests.get", good_status_get)
+    monkeypatch.setattr("cli.api._session.get", good_status_get)
     upload_status = api.poll_upload_merge_status(1, UPLOAD_TOKEN)
     assert upload_status.retry_in is None
     assert upload_status.status == status_res["status"]
@@ -315,6 +328,15 @@ def test_retry_with_reauth(runner, capsys, monkeypatch):
         # User is re-prompted 5 times
         assert stdout.count("paste your copied token below") == 5
 
+        # Simulate a user entering too many invalid tokens
+        cache.store(auth.TOKEN, bad_token)
+        monkeypatch.setattr("sys.stdin", StringIO("\n" * (api.MAX_REAUTH_ATTEMPTS + 1)))
+        with pytest.raises(auth.AuthError, match="not authenticated"):
+            req_401()
+
+        stdout = capsys.readouterr().out
+        assert stdout.count(bad_token) == api.MAX_REAUTH_ATTEMPTS
+
         # Simulate a user having pyperclip issues
         def throw():
             raise Exception
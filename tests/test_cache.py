@@ -20,3 +20,18 @@ def test_cache_hit(runner: CliRunner):
 def test_cache_miss(runner: CliRunner):
     """Test that we can't get an object that doesn't exist in the cache."""
     assert cache.get("missing key") is None
+
+
+def test_cache_sees_other_processes(runner: CliRunner, monkeypatch):
+    """Test that values stored by another CLI process are picked up."""
+    key = "foo"
+    monkeypatch.setattr(cache, "_cache_dir", lambda: "workdir")
+
+    with runner.isolated_filesystem():
+        cache.store(key, "bar")
+        assert cache.get(key) == "bar"
+
+        # e.g., `cidc login` in another terminal during a long upload
+        with open(cache._key_path(key), "w") as f:
+            f.write("baz")
+        assert cache.get(key) == "baz"
@@ -52,6 +52,22 @@ def test_cidc_structure(runner: CliRunner, monkeypatch):
     assert "Usage: cidc login" in res.output
 
 
+@with_default_env
+def test_env_warning(runner: CliRunner, monkeypatch):
+    """Check that mismatched environments are reported in the command's output"""
+    skip_consent(monkeypatch)
+
+    res = runner.invoke(cli.cidc, ["--ignore", "dev", "version"])
+    assert "You are using PRODUCTION environment, not dev" in res.output
+    assert "Remove `--ignore dev` and retry." in res.output
+    assert f"cidc-cli {__version__}" not in res.output
+
+    config.set_env("dev")
+    res = runner.invoke(cli.cidc, ["--ignore", "dev", "version"])
+    assert "You are using DEVELOPMENT environment (dev)" in res.output
+    assert f"cidc-cli {__version__}" in res.output
+
+
 @with_default_env
 def test_no_gcloud_installation(runner: CliRunner, monkeypatch):
     """
@@ -67,6 +83,10 @@ def test_no_gcloud_installation(runner: CliRunner, monkeypatch):
     assert_gcloud_message(runner.invoke(cli.cidc, ["assays"]))
     assert_gcloud_message(runner.invoke(cli.cidc, ["login"]))
 
+    # Commands that don't use gcloud shouldn't require it
+    res = runner.invoke(cli.cidc, ["version"])
+    assert f"cidc-cli {__version__}" in res.output
+
 
 @with_default_env
 def test_assays_list(runner: CliRunner, monkeypatch):
@@ -0,0 +1,49 @@
+import subprocess
+from unittest.mock import MagicMock
+
+from cli import gcloud
+
+EMAIL = "test@example.com"
+
+
+def mock_gcloud(monkeypatch, account: str, account_rc: int = 0, token_rc: int = 0):
+    """Mock `subprocess.run` calls to gcloud, and spy on `subprocess.call`"""
+
+    def run(args, **kwargs):
+        if args[1:] == ["config", "get-value", "account"]:
+            return subprocess.CompletedProcess(args, account_rc, f"{account}\n", "")
+        assert args[1:] == ["auth", "print-access-token", EMAIL]
+        return subprocess.CompletedProcess(args, token_rc, b"token", b"")
+
+    monkeypatch.setattr("subprocess.run", run)
+    monkeypatch.setattr("cli.auth.get_user_email", lambda: EMAIL)
+    call = MagicMock()
+    monkeypatch.setattr("subprocess.call", call)
+    return call
+
+
+def test_login_skipped_when_logged_in(monkeypatch):
+    """Check that no interactive login happens if gcloud already has working credentials"""
+    call = mock_gcloud(monkeypatch, EMAIL)
+    assert gcloud._is_logged_in(EMAIL)
+    gcloud.login()
+    call.assert_not_called()
+
+
+def test_login_other_account(monkeypatch):
+    """Check that users logged in to gcloud under another account are logged in"""
+    for account, account_rc in [("other@example.com", 0), ("", 0), ("", 1)]:
+        call = mock_gcloud(monkeypatch, account, account_rc=account_rc)
+        assert not gcloud._is_logged_in(EMAIL)
+        gcloud.login()
+        call.assert_called_once()
+        assert call.call_args[0][0][1:4] == ["auth", "login", EMAIL]
+
+
+def test_login_expired_credentials(monkeypatch):
+    """Check that users whose gcloud credentials can't produce a token are logged in"""
+    call = mock_gcloud(monkeypatch, EMAIL, token_rc=1)
+    assert not gcloud._is_logged_in(EMAIL)
+    gcloud.login()
+    call.assert_called_once()
+    assert call.call_args[0][0][1:4] == ["auth", "login", EMAIL]
@@ -1,8 +1,12 @@
+import sys
 import time
+import subprocess
+from io import BytesIO, StringIO, TextIOWrapper
 from unittest.mock import MagicMock
 
 import pytest
 import click
+import requests
 from click.testing import CliRunner
 
 from cli import api
@@ -106,9 +110,30 @@ def test_upload_success(runner: CliRunner, monkeypatch):
     run_isolated_upload(runner)
 
     upload_success.assert_called_once()
+    # The file mapping composed alongside the extra metadata upload is used
+    _, upload_pairs, skipping = upload_success.call_args[0]
+    assert len(upload_pairs) == len(URL_MAPPING)
+    assert skipping == []
     mocks.assert_expected_calls()
 
 
+def test_upload_extra_metadata_failure(runner: CliRunner, monkeypatch):
+    """
+    Check that a failed extra metadata upload is reported before any
+    (possibly slow) bucket listings start.
+    """
+    mocks = UploadMocks(monkeypatch)
+    mocks.insert_extra_metadata.side_effect = api.ApiError("bad metadata")
+
+    compose_file_mapping = MagicMock()
+    monkeypatch.setattr(upload, "_compose_file_mapping", compose_file_mapping)
+
+    with pytest.raises(api.ApiError, match="bad metadata"):
+        run_isolated_upload(runner)
+    compose_file_mapping.assert_not_called()
+    mocks.assert_expected_calls(failure=True)
+
+
 def test_upload_interrupt(runner: CliRunner, monkeypatch):
     """
     Check that a KeyboardInterrupt-ed upload call alerts the API that the job errored.
@@ -235,6 +260,24 @@ def test_poll_for_upload_completion(monkeypatch):
     assert "failed" in failure_stdout
     assert "some error details" in failure_stdout
 
+    click_echo.reset_mock()
+    sleep.reset_mock()
+
+    # Simulate transient connection errors followed by a success
+    flaky = MagicMock()
+    flaky.side_effect = [
+        requests.ConnectionError(),
+        requests.ConnectionError(),
+        api.MergeStatus("merge-completed", None, None),
+    ]
+    monkeypatch.setattr(api, "poll_upload_merge_status", flaky)
+    upload._poll_for_upload_completion(
+        job_id, UPLOAD_TOKEN, _did_timeout_test_impl=get_did_timeout(5)
+    )
+    assert flaky.call_count == 3
+    assert [c[0][0] for c in sleep.call_args_list] == [1, 2]
+    assert "succeeded" in stdout()
+
 
 def test_simultaneous_uploads(runner: CliRunner, monkeypatch):
     """
@@ -249,7 +292,7 @@ def test_simultaneous_uploads(runner: CliRunner, monkeypatch):
     gsutil_command.return_value.args = ["gsutil", "arg1", "arg2"]
     gsutil_command.return_value.poll = lambda: 0
     gsutil_command.return_value.returncode = 0
-    gsutil_command.return_value.stderr = MagicMock("stderr")
+    gsutil_command.return_value.stderr = MagicMock()
     gsutil_command.return_value.stderr.readline = lambda: "gsutil progress"
     monkeypatch.setattr("subprocess.Popen", gsutil_command)
 
@@ -273,6 +316,10 @@ def test_handle_upload_exc():
     with pytest.raises(RuntimeError, match="failed.\nfoo"):
         upload._handle_upload_exc(RuntimeError("foo"))
 
+    with pytest.raises(Exception, match="failed.\nCommand 'gsutil' returned") as e:
+        upload._handle_upload_exc(subprocess.CalledProcessError(1, "gsutil"))
+    assert isinstance(e.value.__cause__, subprocess.CalledProcessError)
+
 
 def test_gsutil_assay_upload(monkeypatch):
     """Check that _gsutil_assay_upload waits for all file upload processes to complete"""
@@ -285,7 +332,7 @@ def test_gsutil_assay_upload(monkeypatch):
             proc.start()
             yield proc
 
-    def _wait_for_upload(procs, total, optional_files):
+    def _wait_for_upload(procs, total, optional_files, **kwargs):
         """Mock the _wait_for_upload function"""
         assert total == num_procs
         for proc in procs:
@@ -294,9 +341,6 @@ def test_gsutil_assay_upload(monkeypatch):
 
     monkeypatch.setattr(upload, "_start_procs", _start_procs)
     monkeypatch.setattr(upload, "_wait_for_upload", _wait_for_upload)
-    monkeypatch.setattr(
-        upload, "_compose_file_mapping", lambda *args: ([0] * num_procs, [])
-    )
 
     upload._gsutil_assay_upload(
         api.UploadInfo(
@@ -309,7 +353,8 @@ def test_gsutil_assay_upload(monkeypatch):
             OPTIONAL_FILES,
             UPLOAD_TOKEN,
         ),
-        "",
+        [0] * num_procs,
+        [],
     )
 
     # Ensure that _gsutil_assay_upload has started and waited for every process
@@ -318,6 +363,233 @@ def test_gsutil_assay_upload(monkeypatch):
         proc.stop.assert_called()
 
 
+def test_open_file_mapping(tmpdir, monkeypatch):
+    """Check that _open_file_mapping opens and closes files, and rejects GCS paths"""
+    xlsx = str(tmpdir.join("wes.xlsx"))
+    tmpdir.join("lp1").write("foo")
+
+    with upload._open_file_mapping({"lp1": "uuid1"}, xlsx) as open_files:
+        assert open_files["uuid1"].read() == b"foo"
+    assert open_files["uuid1"].closed
+
+    # GCS paths are rejected before any local files are opened
+    mock_open = MagicMock()
+    monkeypatch.setattr(upload, "open", mock_open, raising=False)
+    with pytest.raises(Exception, match="not supported"):
+        with upload._open_file_mapping(
+            {"lp1": "uuid1", "gs://bucket/lp2": "uuid2"}, xlsx
+        ):
+            pass
+    mock_open.assert_not_called()
+
+
+def test_list_local_files(tmpdir):
+    """Check that _list_local_files lists only regular files"""
+    tmpdir.join("a.fastq").write("foo")
+    tmpdir.mkdir("subdir")
+    assert upload._list_local_files(str(tmpdir)) == {"a.fastq"}
+    assert upload._list_local_files(str(tmpdir.join("missing"))) == set()
+
+
+def test_wait_for_upload_returns_early():
+    """Check that _wait_for_upload can return once any one upload finishes"""
+
+    def make_proc(returncodes):
+        proc = MagicMock()
+        proc.args = ["gsutil", "cp", "src", "dst"]
+        proc.stderr.readline.return_value = ""
+        proc.poll.side_effect = returncodes
+        proc.returncode = 0
+        return proc
+
+    finishes = make_proc([None, 0, 0])
+    keeps_running = make_proc([None] * 10)
+
+    err = upload._wait_for_upload([finishes, keeps_running], 2, [], wait_for_all=False)
+    assert err is None
+    finishes.stderr.close.assert_called_once()
+    keeps_running.stderr.close.assert_not_called()
+
+
+# stand-in for `gsutil cp src dst`: "slow" uploads keep reporting progress
+# for a long time, "bad" uploads fail
+# (with an error message, unless they're "silent"), and the rest succeed
+GSUTIL_CP_SCRIPT = """
+import sys, time
+src = sys.argv[1]
+if src.startswith("slow"):
+    for _ in range(600):
+        sys.stderr.write("/ [0 files][    0.0 B/  1 KiB]\\n")
+        sys.stderr.flush()
+        time.sleep(0.05)
+elif src.startswith("bad"):
+    if "silent" not in src:
+        sys.stderr.write("CommandException: upload failed\\nAccessDeniedException: 403\\n")
+    sys.exit(1)
+else:
+    sys.stderr.write("[1 files][ 1 KiB/ 1 KiB] Done\\n")
+"""
+
+
+def mock_gsutil_cp(monkeypatch) -> dict:
+    """Run GSUTIL_CP_SCRIPT in place of gsutil, returning the processes by source"""
+    procs = {}
+
+    def _start_procs(upload_pairs):
+        for src, dst in upload_pairs:
+            proc = subprocess.Popen(
+                [sys.executable, "-c", GSUTIL_CP_SCRIPT, src, dst],
+                universal_newlines=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+            procs[src] = proc
+            yield proc
+
+    monkeypatch.setattr(upload, "_start_procs", _start_procs)
+    return procs
+
+
+def gsutil_assay_upload(upload_pairs: list):
+    """Run _gsutil_assay_upload on the given pairs for a test upload job"""
+    upload._gsutil_assay_upload(
+        api.UploadInfo(
+            JOB_ID,
+            JOB_ETAG,
+            GCS_BUCKET,
+            URL_MAPPING,
+            EXTRA_METADATA,
+            GCS_FILE_MAP,
+            OPTIONAL_FILES,
+            UPLOAD_TOKEN,
+        ),
+        upload_pairs,
+        [],
+    )
+
+
+def test_gsutil_assay_upload_closes_pipes(monkeypatch, capsys):
+    """Check that every upload's output is read and its stderr pipe closed"""
+    num_procs = 30
+    monkeypatch.setenv("CIDC_GSUTIL_PROCS", "4")
+    procs = mock_gsutil_cp(monkeypatch)
+
+    gsutil_assay_upload([(f"src{n}", f"dst{n}") for n in range(num_procs)])
+
+    assert len(procs) == num_procs
+    assert all(p.stderr.closed for p in procs.values())
+    out = capsys.readouterr().out
+    for n in range(num_procs):
+        assert f"Done src{n}\n" in out
+
+
+def test_gsutil_assay_upload_failure(monkeypatch, capsys):
+    """Check that a failed upload aborts, naming the file, and stops the others"""
+    monkeypatch.setenv("CIDC_GSUTIL_PROCS", "4")
+
+    for bad, message in [
+        ("bad", "CommandException: upload failed\nAccessDeniedException: 403"),
+        ("bad-silent", "gsutil exited with 1"),
+    ]:
+        procs = mock_gsutil_cp(monkeypatch)
+        pairs = [("src0", "dst0"), ("slow", "dst1"), (bad, "dst2")]
+        try:
+            with pytest.raises(click.Abort):
+                gsutil_assay_upload(pairs)
+
+            out = capsys.readouterr().out
+            assert f"GCS upload failed on {bad} with" in out
+            assert message in out
+            assert "All files uploaded" not in out
+            # the upload still running was stopped
+            assert procs["slow"].wait(timeout=5) != 0
+        finally:
+            for p in procs.values():
+                p.kill()
+                p.wait()
+                p.stderr.close()
+
+
+def test_max_gsutil_procs(monkeypatch):
+    """Check that CIDC_GSUTIL_PROCS is validated when it's used"""
+    monkeypatch.delenv("CIDC_GSUTIL_PROCS", raising=False)
+    assert upload._max_gsutil_procs() == upload.MAX_GSUTIL_PARALLEL_PROCESS
+
+    monkeypatch.setenv("CIDC_GSUTIL_PROCS", "")
+    assert upload._max_gsutil_procs() == upload.MAX_GSUTIL_PARALLEL_PROCESS
+
+    monkeypatch.setenv("CIDC_GSUTIL_PROCS", "4")
+    assert upload._max_gsutil_procs() == 4
+
+    monkeypatch.setenv("CIDC_GSUTIL_PROCS", "0")
+    assert upload._max_gsutil_procs() == 1
+
+    monkeypatch.setenv("CIDC_GSUTIL_PROCS", "four")
+    with pytest.raises(click.ClickException, match="CIDC_GSUTIL_PROCS"):
+        upload._max_gsutil_procs()
+
+    # a bad value stops an upload before anything else happens
+    login = MagicMock()
+    monkeypatch.setattr(upload.gcloud, "login", login)
+    with pytest.raises(click.ClickException, match="CIDC_GSUTIL_PROCS"):
+        upload.run_upload("wes", "wes.xlsx")
+    login.assert_not_called()
+
+
+def test_gsutil_assay_upload_keeps_procs_running(monkeypatch):
+    """Check that _gsutil_assay_upload starts a new upload as soon as another finishes"""
+    num_procs = 13
+    max_procs = 3
+    monkeypatch.setattr(upload, "MAX_GSUTIL_PARALLEL_PROCESS", max_procs)
+
+    class Proc:
+        done = False
+
+        def poll(self):
+            return 0 if self.done else None
+
+    procs_started = []
+
+    def _start_procs(*args):
+        """Mock the _start_procs function"""
+        for _ in range(num_procs):
+            proc = Proc()
+            procs_started.append(proc)
+            yield proc
+
+    max_running = 0
+
+    def _wait_for_upload(procs, total, optional_files, wait_for_all, **kwargs):
+        """Mock the _wait_for_upload function, finishing one upload at a time"""
+        nonlocal max_running
+        running = [p for p in procs if not p.done]
+        max_running = max(max_running, len(running))
+        for p in running if wait_for_all else running[:1]:
+            p.done = True
+
+    monkeypatch.setattr(upload, "_start_procs", _start_procs)
+    monkeypatch.setattr(upload, "_wait_for_upload", _wait_for_upload)
+
+    upload._gsutil_assay_upload(
+        api.UploadInfo(
+            JOB_ID,
+            JOB_ETAG,
+            GCS_BUCKET,
+            URL_MAPPING,
+            EXTRA_METADATA,
+            GCS_FILE_MAP,
+            OPTIONAL_FILES,
+            UPLOAD_TOKEN,
+        ),
+        [0] * num_procs,
+        [],
+    )
+
+    assert len(procs_started) == num_procs
+    assert all(p.done for p in procs_started)
+    assert max_running == max_procs
+
+
 def test_compose_file_mapping(tmpdir, monkeypatch):
     xlsx = str(tmpdir.join("bar.xlsx"))
 
@@ -335,6 +607,23 @@ def test_compose_file_mapping(tmpdir, monkeypatch):
     with pytest.raises(Exception, match="Could not locate"):
         upload._compose_file_mapping(upload_job, xlsx)
 
+    # doesn't list GCS buckets if a local file is already missing
+    ls_subprocess = MagicMock()
+    monkeypatch.setattr("subprocess.Popen", ls_subprocess)
+    upload_job = api.UploadInfo(
+        JOB_ID,
+        JOB_ETAG,
+        GCS_BUCKET,
+        {**failing_map, "gs://bucket/gcs.path": "test/gcs.2"},
+        EXTRA_METADATA,
+        GCS_FILE_MAP,
+        OPTIONAL_FILES,
+        UPLOAD_TOKEN,
+    )
+    with pytest.raises(Exception, match="Could not locate"):
+        upload._compose_file_mapping(upload_job, xlsx)
+    ls_subprocess.assert_not_called()
+
     # doesn't fail if passed as an optional_file
     upload_job = api.UploadInfo(
         JOB_ID,
@@ -384,13 +673,13 @@ def test_compose_file_mapping(tmpdir, monkeypatch):
 
     # mock gsutil ls file check by returning input
     ls_return = MagicMock()
-    ls_return.returncode = 0
-    ls_return.stdout = "gs://bucket:\ngs://bucket/gcs.path\n\ngs://bucket/[brackets]/subitem".encode(
-        "utf-8"
+    ls_return.wait.return_value = 0
+    ls_return.stdout = StringIO(
+        "gs://bucket:\ngs://bucket/gcs.path\n\ngs://bucket/[brackets]/subitem"
     )
     ls_subprocess = MagicMock()
     ls_subprocess.return_value = ls_return
-    monkeypatch.setattr("subprocess.run", ls_subprocess)
+    monkeypatch.setattr("subprocess.Popen", ls_subprocess)
 
     output_map, skipping = upload._compose_file_mapping(upload_job, xlsx)
     assert len(skipping) == 0, skipping
@@ -409,9 +698,75 @@ def test_compose_file_mapping(tmpdir, monkeypatch):
             assert v == f"gs://{GCS_BUCKET}/test/gcs.3"
 
     # now don't return one of them and see it fail
-    ls_return.stdout = "gs://bucket:\ngs://bucket/gcs.path\n".encode("utf-8")
-    ls_subprocess.return_value = ls_return
-    monkeypatch.setattr("subprocess.run", ls_subprocess)
+    ls_return.stdout = StringIO("gs://bucket:\ngs://bucket/gcs.path\n")
 
     with pytest.raises(Exception, match=r"gs://bucket/\[brackets\]/subitem"):
         output_map, skipping = upload._compose_file_mapping(upload_job, xlsx)
+
+
+def test_check_for_gs_files(monkeypatch):
+    """Check that every source bucket is listed and its files are matched"""
+    listings = {
+        "gs://bucket1": "gs://bucket1/a.fastq\n",
+        "gs://bucket2": "gs://bucket2/dir/:\ngs://bucket2/dir/b.fastq\n",
+    }
+
+    def ls_subprocess(args, **kwargs):
+        res = MagicMock()
+        res.wait.return_value = 0
+        res.stdout = StringIO(listings[args[-1]])
+        return res
+
+    monkeypatch.setattr("subprocess.Popen", ls_subprocess)
+
+    gs_uris_to_check = {
+        "bucket1": {"gs://bucket1/a.fastq": "a", "gs://bucket1/c.fastq": "c"},
+        "bucket2": {"gs://bucket2/dir/b.fastq": "b"},
+    }
+    res, missing_required, missing_optional = upload._check_for_gs_files(
+        gs_uris_to_check, {"gs://bucket1/c.fastq"}, GCS_BUCKET
+    )
+    assert res == [
+        ("gs://bucket1/a.fastq", f"gs://{GCS_BUCKET}/a"),
+        ("gs://bucket2/dir/b.fastq", f"gs://{GCS_BUCKET}/b"),
+    ]
+    assert missing_required == []
+    assert missing_optional == ["c"]
+
+    # a failed listing aborts
+    def failed_ls_subprocess(args, **kwargs):
+        res = MagicMock()
+        res.wait.return_value = 1
+        res.stdout = StringIO("AccessDeniedException: 403\n")
+        return res
+
+    monkeypatch.setattr("subprocess.Popen", failed_ls_subprocess)
+    with pytest.raises(click.Abort):
+        upload._check_for_gs_files(gs_uris_to_check, set(), GCS_BUCKET)
+
+
+def test_list_gs_bucket(monkeypatch):
+    """Check that bucket listings are decoded as UTF-8 and gsutil is cleaned up"""
+    listing = "gs://bucket/dir/:\ngs://bucket/dir/échantillon_ü.fastq\n"
+
+    def ls_subprocess(args, encoding=None, errors=None, **kwargs):
+        # decode the way a real pipe would, rather than with the test's locale
+        res = MagicMock()
+        res.wait.return_value = 0
+        res.stdout = TextIOWrapper(
+            BytesIO(listing.encode("utf-8")), encoding=encoding, errors=errors
+        )
+        return res
+
+    monkeypatch.setattr("subprocess.Popen", ls_subprocess)
+    assert upload._list_gs_bucket("bucket") == {"gs://bucket/dir/échantillon_ü.fastq"}
+
+    # gsutil is killed and waited on if reading the listing fails
+    proc = MagicMock()
+    proc.stdout.__iter__.side_effect = KeyboardInterrupt
+    monkeypatch.setattr("subprocess.Popen", lambda *args, **kwargs: proc)
+    with pytest.raises(KeyboardInterrupt):
+        upload._list_gs_bucket("bucket")
+    proc.kill.assert_called_once()
+    proc.wait.assert_called_once()
+    proc.stdout.close.assert_called_once()